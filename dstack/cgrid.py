@@ -52,9 +52,13 @@ def measure_grid_sparseness(cimgrid_path,chan=0,pol=0):
     
     assert cgrid.datatype() == 'Complex', 'Input CASAImage is not complex, and grids are axpected to be complex!'
 
-    gird_size = cgrid.shape()[2] * cgrid.shape()[3]
+    grid_shape = cgrid.shape()
+    gird_size = grid_shape[2] * grid_shape[3]
 
-    sparseness = (gird_size - np.count_nonzero(cgrid.getdata()[chan,pol,...])) / gird_size
+    #Read only the selected channel and polarization slab from disk
+    grid_slab = ds.cim.get_CIM_slab(cgrid, chan, pol)
+
+    sparseness = (gird_size - np.count_nonzero(grid_slab)) / gird_size
 
     return sparseness
 
@@ -5,20 +5,26 @@ hence functions defined in this module works on both images and grids.
 The image I/O management is kinda manually at this point, but hopefully will be handled on higher level applications in the future.
 """
 
-__all__ = ['create_CIM_object', 'get_N_chan_from_CIM', 'get_N_pol_from_CIM',
+__all__ = ['CIMInfo', 'create_CIM_object', 'describe_CIM', 'get_N_chan_from_CIM', 'get_N_pol_from_CIM',
             'measure_CIM_RMS', 'check_CIM_equity', 'check_CIM_coordinate_equity', 
-            'create_CIM_diff_array', 'CIM_stacking_base']
+            'create_CIM_diff_array', 'iterate_CIM_diff_slabs', 'CIM_stacking_base']
 
 import os
 import shutil
 import numpy as np
 import warnings
 
+from collections import namedtuple
+from contextlib import closing
+
 from casacore import images as casaimage
 from casacore import tables as casatables
 
 import dstack as ds
 
+#Metadata of a CASAImage, read in once so it can be accessed without calling casacore again
+CIMInfo = namedtuple('CIMInfo', 'img ndim shape dtype unit name')
+
 def create_CIM_object(cimpath):
     """This function aims to speed up other bits of this and ``cgrid``
     modules, by returning a ``casacore.images.image.image`` object.
@@ -42,15 +48,45 @@ def create_CIM_object(cimpath):
         The in-memory CASAImage
 
     """
-    #create an empty image in-memory to check the object type
-    #if type(cimpath) == type(casaimage.image(imagename='',shape=np.ones(1))):
-    if type(cimpath) == 'casacore.images.image.image':
+    #Check the object type, so already opened images are not read in again
+    if isinstance(cimpath, casaimage.image):
         return cimpath
     else:
         # We could simply return, no need to assign the return value of
         # `casaimage.image(cimpath)` to a new variable.
         return casaimage.image(cimpath)
 
+def describe_CIM(cimpath):
+    """Collect the metadata of a CASAImage into a ``CIMInfo`` named tuple.
+
+    Each metadata query is a call to casacore, hence functions working on a lot of
+    images (e.g. ``CIM_stacking_base``) are better off querying them only once per
+    image and using the attributes of the returned tuple afterwards.
+
+    Parameters
+    ==========
+    cimpath: str
+        The input CASAImage path or a ``casacore.images.image.image`` object
+
+    Returns
+    =======
+    info: ``CIMInfo``
+        Named tuple with the fields:
+        img (the in-memory CASAImage), ndim, shape, dtype (the casacore data type string),
+        unit and name
+
+        The coordinate system is not included, as decoding it is expensive, and it is
+        checked by ``check_CIM_coordinate_equity`` anyway.
+    """
+    cim = ds.cim.create_CIM_object(cimpath)
+
+    return CIMInfo(img=cim,
+                ndim=cim.ndim(),
+                shape=tuple(cim.shape()),
+                dtype=cim.datatype(),
+                unit=cim.unit(),
+                name=cim.name())
+
 def check_axes(cim, required_axes=4):
     """Checks if the ``cim`` image object has the correct number of
     axes or dimensions. Raises
@@ -83,6 +119,34 @@ def check_axes(cim, required_axes=4):
         numbers.
     """
     assert cim.ndim() == required_axes, 'The image has more than 4 axes!'
+
+def get_CIM_slab(cim, chan=0, pol=0):
+    """Read a single channel and polarization slab from a CASAImage.
+
+    Only the selected (x,y) plane is read from disk, rather than reading
+    the full image cube and slicing it afterwards.
+
+    CASAImage indices: [freq, Stokes, x, y]
+
+    Parameters
+    ==========
+    cim: ``casacore.images.image.image`` object
+        In-memory CASAImage
+
+    chan: int
+        Index of the channel in the image cube
+
+    pol: int
+        Index of the polarization in the image cube
+
+    Returns
+    =======
+    slab: numpy ndarray
+        The 2D (x,y) pixel data of the given channel and polarization
+    """
+    shape = cim.shape()
+
+    return cim.getdata(blc=[chan, pol, 0, 0], trc=[chan, pol, shape[2] - 1, shape[3] - 1])[0,0,...]
     
 
 # one space should follow each comma (,)
@@ -109,7 +173,7 @@ def get_N_chan_from_CIM(cimpath, close=False):
     cim = ds.cim.create_CIM_object(cimpath)
     assert cim.ndim() == 4, 'The image has more than 4 axes!'
 
-    N_chan = np.shape(cim.getdata())[0]
+    N_chan = cim.shape()[0]
 
     if close:
         del cim
@@ -141,13 +205,135 @@ def get_N_pol_from_CIM(cimpath, close=False):
     cim = ds.cim.create_CIM_object(cimpath)
     assert cim.ndim() == 4, 'The image has more than 4 axes!'
 
-    N_pol = np.shape(cim.getdata())[1]
+    N_pol = cim.shape()[1]
 
     if close:
         del cim
 
     return N_pol
 
+def fast_allclose(a, b, rtol):
+    """Memory efficient version of ``np.allclose(a, b, atol=0, rtol=rtol, equal_nan=True)``
+    for real valued arrays.
+
+    ``np.allclose`` allocates a new temporary array for each step of the comparison.
+    Here a single buffer is reused for computing ``|a - b|`` and an other for ``rtol * |b|``,
+    which matters when comparing large image cubes.
+
+    Parameters
+    ==========
+    a: numpy ndarray
+        Real valued array of Alice
+
+    b: numpy ndarray
+        Real valued array of Bob, with the same shape as Alice
+
+    rtol: float
+        The maximum allowed relative difference, normalised by Bob
+
+    Returns
+    =======
+    equity: bool
+        True if all elements are equal within the relative tolerance, and False otherwise.
+        NaN-s are treated as equals.
+    """
+    #Subtracting infinities or NaN-s raises a warning, but those are handled below
+    with np.errstate(invalid='ignore'):
+        diff = np.subtract(a, b)
+    np.abs(diff, out=diff)
+
+    tol = np.abs(b)
+    np.multiply(tol, rtol, out=tol)
+
+    close = np.less_equal(diff, tol)
+    del diff, tol
+
+    #The tolerance is infinite where Bob is infinite, so the test above is only valid for finite values
+    close &= np.isfinite(b)
+
+    #Infinities with the same sign are equal, but their difference is NaN
+    close |= np.equal(a, b)
+    close |= np.isnan(a) & np.isnan(b)
+
+    return bool(close.all())
+
+def any_mismatch(a, b, rtol, chunk_size=65536):
+    """Check if any element of two arrays differ more than the relative tolerance.
+    This is the negation of ``np.allclose(a, b, atol=0, rtol=rtol, equal_nan=True)``.
+
+    Neither ``np.allclose`` nor ``np.isclose(...).all()`` returns before comparing all
+    elements. Here the flattened arrays are compared in chunks that fit into the CPU cache,
+    and the function returns at the first chunk containing a mismatch.
+
+    Parameters
+    ==========
+    a: numpy ndarray
+        Array of Alice
+
+    b: numpy ndarray
+        Array of Bob, with the same shape as Alice
+
+    rtol: float
+        The maximum allowed relative difference, normalised by Bob
+
+    chunk_size: int, optional
+        Number of elements compared at once
+
+    Returns
+    =======
+    mismatch: bool
+        True if at least one element differs more than the relative tolerance, and False otherwise.
+        NaN-s are treated as equals.
+    """
+    real_valued = a.dtype.kind == 'f' and b.dtype.kind == 'f'
+
+    #These are views for contiguous arrays, e.g. a slab of an image cube
+    a = np.ravel(a)
+    b = np.ravel(b)
+
+    for chunk_start in range(0,a.size,chunk_size):
+        a_chunk = a[chunk_start:chunk_start + chunk_size]
+        b_chunk = b[chunk_start:chunk_start + chunk_size]
+
+        if real_valued:
+            chunk_equity = ds.cim.fast_allclose(a_chunk,b_chunk,rtol)
+        else:
+            chunk_equity = np.allclose(a_chunk,b_chunk,atol=0,rtol=rtol,equal_nan=True)
+
+        if not chunk_equity:
+            return True
+
+    return False
+
+def chunked_allclose(a, b, rtol):
+    """Compare two image cubes slab-by-slab, where a slab is a single channel and
+    polarization (x,y) plane. Equivalent to ``np.allclose(a, b, atol=0, rtol=rtol, equal_nan=True)``,
+    but the temporary arrays of the comparison are only the size of a chunk of a slab rather than the
+    whole cube, and the comparison stops at the first chunk that differs (see ``any_mismatch``).
+
+    Parameters
+    ==========
+    a: numpy ndarray
+        Array of Alice
+
+    b: numpy ndarray
+        Array of Bob, with the same shape as Alice
+
+    rtol: float
+        The maximum allowed relative difference, normalised by Bob
+
+    Returns
+    =======
+    equity: bool
+        True if all elements are equal within the relative tolerance, and False otherwise.
+        NaN-s are treated as equals.
+    """
+    for index in np.ndindex(a.shape[:-2]):
+        if ds.cim.any_mismatch(a[index],b[index],rtol):
+            return False
+
+    return True
+
 # one space should follow each comma (,)
 def check_CIM_equity(cimpath_a, cimpath_b, numprec=1e-8, close=False):
     """Check if two CASAImages are identical or not up to a defined numerical precision
@@ -155,6 +341,9 @@ def check_CIM_equity(cimpath_a, cimpath_b, numprec=1e-8, close=False):
 
     Note: NaN-s are treated as equals, and the ``numprec`` parameter only sets the relative difference limit.
 
+    The images are read and compared one channel and polarization slab at a time, and the
+    comparison stops at the first slab that differs.
+
     Parameters
     ==========
     cimpath_a: str
@@ -184,10 +373,28 @@ def check_CIM_equity(cimpath_a, cimpath_b, numprec=1e-8, close=False):
 
     assert cimA.ndim() == cimB.ndim(), 'The dimension of the two input CASAImage is not equal!'
 
-    if numprec == 0.:
-        equviv = np.array_equiv(cimA.getdata(),cimB.getdata())
+    #Images with different shapes can not be equal, and the comparison
+    #functions below would silently broadcast them
+    if cimA.shape() != cimB.shape():
+        equviv = False
     else:
-        equviv = np.allclose(cimA.getdata(),cimB.getdata(),atol=0,rtol=numprec,equal_nan=True)
+        #The images are compared slab-by-slab, so only a single (x,y) plane of each
+        #image is read at once, and no more slabs are read after the first mismatch
+        check_axes(cimA)
+
+        equviv = True
+        for chan, pol in np.ndindex(tuple(cimA.shape()[:2])):
+            a = ds.cim.get_CIM_slab(cimA,chan,pol)
+            b = ds.cim.get_CIM_slab(cimB,chan,pol)
+
+            if numprec == 0.:
+                slab_mismatch = not np.array_equiv(a,b)
+            else:
+                slab_mismatch = ds.cim.any_mismatch(a,b,numprec)
+
+            if slab_mismatch:
+                equviv = False
+                break
 
     if close:
         del cimA
@@ -254,8 +461,12 @@ def check_CIM_coordinate_equity(cimpath_a, cimpath_b, close=False):
     # Similarly I would refactor the unit checks.
     assert cimA.unit() == cimB.unit(), 'The pixel units of the two input CASAImage is not equal!'
 
+    #The image names are only needed for the messages, but used in a lot of them
+    nameA = cimA.name()
+    nameB = cimB.name()
+
     coordsA = cimA.coordinates()
-    coordsB = cimA.coordinates()
+    coordsB = cimB.coordinates()
 
     #Spectral coordinates
     coords_axis = 'spectral'
@@ -265,77 +476,72 @@ def check_CIM_coordinate_equity(cimpath_a, cimpath_b, close=False):
     # save their value into a separate variable. This also saves
     # some CPU time by executing the "lookup" operation
     # (the [] operator)only once.
-    # Similarly other temporary values that are used more than one
-    # time, could be saved into a variable. E.g. ``cimA.name()`` and
-    # ``cimB.name()``.
     
     axis_a, axis_b = coordsA[coords_axis], coordsB[coords_axis]
     
     assert axis_a.get_frame() == axis_b.get_frame(), \
-    'The given images {0:s} and {1:s} have different frames!'.format(cimA.name(),cimB.name())
+    'The given images {0:s} and {1:s} have different frames!'.format(nameA,nameB)
 
     if axis_a.get_unit() == axis_b.get_unit():
         assert axis_a.get_increment() == axis_b.get_increment(), \
         'The increment of the two spectral coordinates are different for images {0:s} and {1:s}'.format(
-        cimA.name(),cimB.name())
+        nameA,nameB)
         
         assert axis_a.get_restfrequency() == axis_b.get_restfrequency(), \
         'The rest frame frequency of the two spectral coordinates are different for images {0:s} and {1:s}'.format(
-        cimA.name(),cimB.name())
+        nameA,nameB)
 
         if axis_a.get_referencepixel() == axis_b.get_referencepixel():
             assert axis_a.get_referencevalue() == axis_b.get_referencevalue(), \
             'The reference values of the spectral corrdinates are different for images {0:s} and {1:s}'.format(
-            cimA.name(),cimB.name())
+            nameA,nameB)
         else:
             warnings.warn('The input images {0:s} and {1:s} have different spectral coordinate reference pixel!'.format(
-                    cimA.name(),cimB.name()))
+                    nameA,nameB))
     else:
         warnings.warn('The input images {0:s} and {1:s} have different spectral coordinate units!'.format(
-                    cimA.name(),cimB.name()))
+                    nameA,nameB))
 
     #Polarization coordinates
     coords_axis = 'stokes'
 
+    axis_a, axis_b = coordsA[coords_axis], coordsB[coords_axis]
+
     assert axis_a.get_stokes() == axis_b.get_stokes(), \
-    'The polarization frame is different for images {0:s} and {1:s}!'.format(cimA.name(),cimB.name())
+    'The polarization frame is different for images {0:s} and {1:s}!'.format(nameA,nameB)
 
     #Direction coordinates if images and linear coordinates if grids
     coords_axis = 'direction'
     try:
-        assert axis_a.get_frame() == axis_b.get_frame(), \
-        'The given images {0:s} and {1:s} have different frames!'.format(cimA.name(),cimB.name())
+        axis_a, axis_b = coordsA[coords_axis], coordsB[coords_axis]
+    except:
+        #Change to linear coord as the given CASAimage is a grid!
+        coords_axis = 'linear'
 
-        assert axis_a.get_projection() == axis_b.get_projection(), \
-        'The given images {0:s} and {1:s} have different projections!'.format(cimA.name(),cimB.name())
+        axis_a, axis_b = coordsA[coords_axis], coordsB[coords_axis]
 
-    except AssertionError:
-        #re-run the assertion to actually fail the code
+    if coords_axis == 'direction':
         assert axis_a.get_frame() == axis_b.get_frame(), \
-        'The given images {0:s} and {1:s} have different frames!'.format(cimA.name(),cimB.name())
+        'The given images {0:s} and {1:s} have different frames!'.format(nameA,nameB)
 
         assert axis_a.get_projection() == axis_b.get_projection(), \
-        'The given images {0:s} and {1:s} have different projections!'.format(cimA.name(),cimB.name())
-    
-    except:
-        #Change to linear coord as the given CASAimage is a grid!
-        coords_axis = 'linear'
+        'The given images {0:s} and {1:s} have different projections!'.format(nameA,nameB)
 
-    if np.all(np.array(axis_a.get_unit()) == np.array(axis_b.get_unit())):
-        assert np.all(np.array(axis_a.get_increment()) == np.array(axis_b.get_increment())), \
+    if np.array_equal(axis_a.get_unit(), axis_b.get_unit()):
+        assert np.array_equal(axis_a.get_increment(), axis_b.get_increment()), \
         'The increment of the (x,y) direction coordinates are different for the input images {0:s} and {1:s}'.format(
-        cimA.name(),cimB.name())
+        nameA,nameB)
 
-        if np.all(np.array(axis_a.get_referencepixel()) == np.array(axis_b.get_referencepixel())):
-            assert np.all(np.array(axis_a.get_referencevalue()) == np.array(axis_b.get_referencevalue())), \
+        if np.array_equal(axis_a.get_referencepixel(), axis_b.get_referencepixel()):
+            assert np.array_equal(axis_a.get_referencevalue(), axis_b.get_referencevalue()), \
             'The reference values of the (x,y) direction corrdinates are different for images {0:s} and {1:s}'.format(
-            cimA.name(),cimB.name())
+            nameA,nameB)
         else:
             warnings.warn('The input images {0:s} and {1:s} have different (x,y) direction coordinate reference pixels!'.format(
-                    cimA.name(),cimB.name()))
+                    nameA,nameB))
     else:
         warnings.warn('The input images {0:s} and {1:s} have different (x,y) direction coordinate units!'.format(
-                    cimA.name(),cimB.name()))
+                    nameA,nameB))
 
     if close:
         del cimA
@@ -365,18 +571,16 @@ def set_CIM_unit(cimpath, unit, overwrite=False):
     ======= 
     Saves the image with the pixel unit included
     """
-    CIMTable = ds.msutil.create_MS_object(cimpath,readonly=False)
-
-    try:
-        CIM_unit = CIMTable.getkeyword('units')
-        if CIM_unit != unit and overwrite == False:
-            warnings.warn('The image {0:s} already has a pixel unit: {1:s} that is different from the given unit: {2:s}!'.format(cimpath,CIM_unit,unit))
-        else:
+    #The table is closed even if writing the unit fails, so the write-lock is released
+    with closing(ds.msutil.create_MS_object(cimpath,readonly=False)) as CIMTable:
+        try:
+            CIM_unit = CIMTable.getkeyword('units')
+            if CIM_unit != unit and overwrite == False:
+                warnings.warn('The image {0:s} already has a pixel unit: {1:s} that is different from the given unit: {2:s}!'.format(cimpath,CIM_unit,unit))
+            else:
+                CIMTable.putkeyword('units', unit)
+        except:
             CIMTable.putkeyword('units', unit)
-    except:
-        CIMTable.putkeyword('units', unit)
-
-    CIMTable.close()
 
 # one space should follow each comma (,)
 def create_CIM_diff_array(cimpath_a, cimpath_b, rel_diff=False, all_dim=False, chan=0, pol=0, close=False):
@@ -424,18 +628,21 @@ def create_CIM_diff_array(cimpath_a, cimpath_b, rel_diff=False, all_dim=False, c
     cimA = ds.cim.create_CIM_object(cimpath_a)
     cimB = ds.cim.create_CIM_object(cimpath_b)
     
-    ensure_same_dims(a, b)
+    ensure_same_dims(cimA, cimB)
 
+    #Read the pixel data only once for each image
     if all_dim:
-        if rel_diff:
-            diff_array = np.divide(np.subtract(cimA.getdata(),cimB.getdata()),cimB.getdata())
-        else:
-            diff_array = np.subtract(cimA.getdata(),cimB.getdata())
+        a = cimA.getdata()
+        b = cimB.getdata()
     else:
-        if rel_diff:
-            diff_array = np.divide(np.subtract(cimA.getdata()[chan,pol,...],cimB.getdata()[chan,pol,...]),cimB.getdata()[chan,pol,...])
-        else:
-            diff_array = np.subtract(cimA.getdata()[chan,pol,...],cimB.getdata()[chan,pol,...])
+        a = get_CIM_slab(cimA, chan, pol)
+        b = get_CIM_slab(cimB, chan, pol)
+
+    #Reuse the difference array as the output buffer for the normalization
+    diff_array = np.subtract(a,b)
+
+    if rel_diff:
+        np.divide(diff_array, b, out=diff_array)
 
     if close:
         del cimA
@@ -443,6 +650,56 @@ def create_CIM_diff_array(cimpath_a, cimpath_b, rel_diff=False, all_dim=False, c
 
     return diff_array
 
+def iterate_CIM_diff_slabs(cimpath_a, cimpath_b, rel_diff=False):
+    """Generator version of ``create_CIM_diff_array`` with ``all_dim=True``.
+    The difference is computed and yielded for each channel and polarization
+    slab one-by-one, and only the given slabs are read from the CASAImages.
+    Thus, the memory usage is bound by the size of a single slab, rather than
+    the full image cube.
+
+    Parameters
+    ==========
+    cimpath_a: str
+        The input CASAImage path of Alice or a ``casacore.images.image.image`` object
+
+    cimpath_b: str
+        The input CASAImage path of Bob or a ``casacore.images.image.image`` object
+
+    rel_diff: bool
+        If True, the relative difference is returned. The code uses Bob to normalize.
+
+    Yields
+    ======
+    chan: int
+        Index of the channel in the image cube
+
+    pol: int
+        Index of the polarization in the image cube
+
+    diff_array: numpy ndarray
+        The difference of the two input CASAImages for the given channel and polarization
+    """
+    cimA = ds.cim.create_CIM_object(cimpath_a)
+    cimB = ds.cim.create_CIM_object(cimpath_b)
+
+    ensure_same_dims(cimA, cimB)
+    check_axes(cimA)
+
+    shape = cimA.shape()
+    assert shape == cimB.shape(), 'The shape of the two input CASAImage is not equal!'
+
+    for chan in range(0,shape[0]):
+        for pol in range(0,shape[1]):
+            a = get_CIM_slab(cimA, chan, pol)
+            b = get_CIM_slab(cimB, chan, pol)
+
+            diff_array = np.subtract(a,b)
+
+            if rel_diff:
+                np.divide(diff_array, b, out=diff_array)
+
+            yield chan, pol, diff_array
+
 # one space should follow each comma (,)
 def measure_CIM_RMS(cimpath, all_dim=False, chan=0, pol=0, close=False):
     """Measure the RMS on a CASAImage either for a given channel and polarization,
@@ -478,26 +735,86 @@ def measure_CIM_RMS(cimpath, all_dim=False, chan=0, pol=0, close=False):
     cim = ds.cim.create_CIM_object(cimpath)
 
     if all_dim:
-        rms_matrix = np.zeros((cim.shape()[0],cim.shape()[1]))
+        data = cim.getdata()
 
-        # I will think about how this operation could be vectorised
-        # so ther will be no need for Python loops.
-        for chan_i in range(0,cim.shape()[0]):
-            for pol_j in range(0,cim.shape()[1]):
-                rms_matrix[i,j] = np.sqrt(np.mean(np.square(cim.getdata()[chan_i,pol_j,...])))
+        #The cube is always [freq, Stokes, x, y], hence it can be viewed as a 2D array
+        #of (chan*pol, x*y) shape without copying the data
+        N_chan, N_pol, N_x, N_y = data.shape
+        slabs = np.ascontiguousarray(data).reshape(N_chan * N_pol, N_x * N_y)
+
+        #Sum of squares over the (x,y) axes for all channels and polarizations at once
+        #einsum does not allocate the temporary squared cube, but the sum has to be
+        #accumulated in double precision, as einsum does not use pairwise summation
+        sum_of_squares = np.einsum('ij,ij->i', slabs, slabs, dtype=np.promote_types(slabs.dtype, np.float64))
+        rms_matrix = np.sqrt(sum_of_squares / (N_x * N_y)).reshape(N_chan, N_pol)
 
         if close:
             del cim
         return rms_matrix
 
     else:
-        rms = np.sqrt(np.mean(np.square(cim.getdata()[chan,pol,...])))
+        slab = get_CIM_slab(cim, chan, pol)
+        rms = np.sqrt(np.einsum('ij,ij->', slab, slab, dtype=np.promote_types(slab.dtype, np.float64)) / slab.size)
         if close:
             del cim
         return rms
 
+def get_CIM_chan_block(cim, chan_start, chan_end):
+    """Read a block of consecutive channels for all polarizations from a CASAImage.
+
+    Only the selected channels are read from disk, rather than reading
+    the full image cube and slicing it afterwards.
+
+    CASAImage indices: [freq, Stokes, x, y]
+
+    Parameters
+    ==========
+    cim: ``casacore.images.image.image`` object
+        In-memory CASAImage
+
+    chan_start: int
+        Index of the first channel of the block
+
+    chan_end: int
+        Index of the channel after the last channel of the block, i.e. the same
+        convention as for slicing
+
+    Returns
+    =======
+    block: numpy ndarray
+        The 4D pixel data of the given channels
+    """
+    shape = cim.shape()
+
+    return cim.getdata(blc=[chan_start, 0, 0, 0], trc=[chan_end - 1, shape[1] - 1, shape[2] - 1, shape[3] - 1])
+
+def read_CIM_chan_block(cimpath, chan_start, chan_end):
+    """Open a CASAImage and read a block of consecutive channels from it (see ``get_CIM_chan_block``).
+    The image is closed after reading, if it was opened by this function, so only the
+    images currently read are kept open by ``CIM_stacking_base``.
+
+    Parameters
+    ==========
+    cimpath: str
+        The input CASAImage path or a ``casacore.images.image.image`` object
+
+    chan_start: int
+        Index of the first channel of the block
+
+    chan_end: int
+        Index of the channel after the last channel of the block
+
+    Returns
+    =======
+    block: numpy ndarray
+        The 4D pixel data of the given channels
+    """
+    cim = ds.cim.create_CIM_object(cimpath)
+
+    return ds.cim.get_CIM_chan_block(cim, chan_start, chan_end)
+
 # one space should follow each comma (,)
-def CIM_stacking_base(cimpath_list, cim_output_path, cim_outputh_name, normalise=False,overwrite=False):
+def CIM_stacking_base(cimpath_list, cim_output_path, cim_outputh_name, normalise=False,overwrite=False,chan_block_size=None):
     """This function is one of the core functions of the image stacking stacking deep spectral line pipelines.
 
     This function takes a list of CASAImages and creates the stacked CASAIMage.
@@ -529,6 +846,26 @@ def CIM_stacking_base(cimpath_list, cim_output_path, cim_outputh_name, normalise
         If True, the stacked image will be created regardless if another image exist
         in the same name. Note, that in this case the existing grid will be deleted!
 
+    chan_block_size: int, optional
+        Number of channels stacked at once. The images are stacked block-by-block, and only
+        the given channels are read from the images, so the memory usage is proportional
+        to the block size rather than the number of channels. If None, all channels are
+        stacked at once.
+
+    Notes
+    =====
+    The stacked image is created as an on-disk copy of the first image, which is then
+    overwritten block-by-block. Hence, the first image is read twice, and the stacked image
+    is written twice, which is the price for not keeping the full cube in memory.
+
+    The pixel mask of the first image is not copied, but its history and attribute groups
+    are inherited by the stacked image, as casacore provides no way to clear them. This is
+    why a warning is raised if these fields of the input images are not empty.
+
+    Only the metadata of the images is kept between reading the blocks, and each image
+    is re-opened for each block. Thus, the number of open files does not grow with the
+    number of images stacked.
+
     Returns
     ========
     Stacked image: CASAImage
@@ -541,10 +878,11 @@ def CIM_stacking_base(cimpath_list, cim_output_path, cim_outputh_name, normalise
 
     if os.path.isdir(output_cim): assert overwrite, 'Stacked image already exist, and the overwrite parameters is set to False!'
 
-    base_cim = ds.cim.create_CIM_object(cimpath_list[0])
+    #The metadata of the base image is the same for each iteration
+    base_info = ds.cim.describe_CIM(cimpath_list[0])
+    base_cim = base_info.img
 
-    #Coordinate system is initialized by the first CASAImages coordinate system
-    coordsys = base_cim.coordinates()
+    check_axes(base_cim)
 
     check_attrgroup_empty = lambda x: None if x.attrgroupnames() == [] else warnings.warn('Input image {0:s} has a non-empty attribute list!'.format(x.name()))
     check_history_empty = lambda x: None if x.history() == [] else warnings.warn('Input image {0:s} has a non-empty history field!'.format(x.name()))
@@ -552,45 +890,62 @@ def CIM_stacking_base(cimpath_list, cim_output_path, cim_outputh_name, normalise
     check_attrgroup_empty(base_cim)
     check_history_empty(base_cim)
 
-    #If shape is given, the data type is automatically set to float!
-    stacked_cim = casaimage.image(output_cim,
-                    coordsys=coordsys,
-                    values=base_cim.getdata(),
-                    overwrite=overwrite)
-    
-    #Keep the data in memory
-    stacked_cim_data = base_cim.getdata()
-
-    #Close the image so the unit can be set
-    del stacked_cim
+    #The stacked image is initialized as a copy of the first CASAImage, thus it has the same
+    #coordinate system and data type (float for images and complex for grids). The copy is done
+    #by casacore without reading the full image into memory. The mask of the first image is
+    #not valid for the stacked image, but its history and attribute groups are inherited
+    base_cim.saveas(output_cim, overwrite=overwrite, copymask=False)
 
     #Set the unit of the resultant image based on the first image
-    ds.cim.set_CIM_unit(output_cim, base_cim.unit())
+    ds.cim.set_CIM_unit(output_cim, base_info.unit)
 
     #Read back the stacked image
     stacked_cim = ds.cim.create_CIM_object(output_cim)
 
+    #Check all images before reading any pixel data
+    #The images are not kept open after the checks, only their paths are stored
+    stack_path_list = []
     for i in range(1,len(cimpath_list)):
-        cim = ds.cim.create_CIM_object(cimpath_list[i])
+        info = ds.cim.describe_CIM(cimpath_list[i])
+
+        assert base_info.dtype == info.dtype, 'The data type of the two input images ({0:s} and {1:s}) are not equal!'.format(base_info.name,info.name)
+        assert base_info.ndim == info.ndim, 'The dimension of the two input images ({0:s} and {1:s}) are not equal!'.format(base_info.name,info.name)
+        assert base_info.shape == info.shape, 'The shape of the two input images ({0:s} and {1:s}) are not equal!'.format(base_info.name,info.name)
+        assert ds.cim.check_CIM_coordinate_equity(info.img,stacked_cim), \
+        'The created stacked image and the image {0:s} have different coordinate systems!'.format(info.name)
+
+        check_attrgroup_empty(info.img)
+        check_history_empty(info.img)
+
+        stack_path_list.append(cimpath_list[i])
+
+        #Deleting the CIM variable closes the image
+        del info
+
+    N_chan = base_info.shape[0]
+
+    if chan_block_size is None:
+        chan_block_size = N_chan
+
+    assert chan_block_size >= 1, 'The channel block size has to be at least one!'
 
-        assert base_cim.datatype() == cim.datatype(), 'The data type of the two input images ({0:s} and {1:s}) are not equal!'.format(base_cim.name(),cim.name())
-        assert base_cim.ndim() == cim.ndim(), 'The dimension of the two input images ({0:s} and {1:s}) are not equal!'.format(base_cim.name(),cim.name())
-        assert ds.cim.check_CIM_coordinate_equity(cim,stacked_cim), \
-        'The created stacked image and the image {0:s} have different coordinate systems!'.format(cim.name())
+    for chan_start in range(0,N_chan,chan_block_size):
+        chan_end = min(chan_start + chan_block_size, N_chan)
 
-        check_attrgroup_empty(cim)
-        check_history_empty(cim)
+        #The running sum is kept in the native data type of the images (e.g. float32)
+        stacked_block = np.ascontiguousarray(ds.cim.get_CIM_chan_block(base_cim, chan_start, chan_end))
 
-        stacked_cim_data = np.add(stacked_cim_data, cim.getdata())
+        for cimpath in stack_path_list:
+            #Accumulate in-place to avoid allocating a new block for each image
+            np.add(stacked_block, ds.cim.read_CIM_chan_block(cimpath, chan_start, chan_end), out=stacked_block, casting='same_kind')
 
-    if normalise:
-        stacked_cim_data = np.divide(stacked_cim_data,len(cimpath_list))
+        if normalise:
+            stacked_block *= stacked_block.dtype.type(1. / len(cimpath_list))
 
-    stacked_cim.putdata(stacked_cim_data)
+        stacked_cim.putdata(stacked_block, blc=[chan_start, 0, 0, 0])
 
     #Deleting the CIM variable closes the image, which release the lock
     del stacked_cim
-    del output_cim
     del base_cim
 
 
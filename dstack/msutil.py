@@ -2,11 +2,15 @@
 Collection of utility functions to interact with Measurement Sets
 """
 
-__all__ = ['create_MS_object', 'get_N_chan_from_MS','get_MS_phasecentre_all',
+__all__ = ['create_MS_object', 'open_MS_table', 'clear_MS_cache', 'get_column_chunked', 'read_MS_phase_dir',
+            'get_N_chan_from_MS','get_MS_phasecentre_all',
             'get_single_phasecentre_from_MS','check_phaseref_in_MS']
 
+import functools
 import numpy as np
 
+from contextlib import closing
+
 from casacore import tables as casatables
 
 from astropy.coordinates import SkyCoord
@@ -44,14 +48,137 @@ def create_MS_object(mspath,ack=False,readonly=True):
         The in-memory Measurement Set
 
     """
-    #create an empty MS in-memory to check the object type
-    #if type(mspath) == type(casatables.table('',casatables.maketabdesc([casatables.makescacoldesc('DATA',0)]),memorytable=True,ack=False)):
-    if type(mspath) == 'casacore.tables.table.table':
+    #Check the object type, so already opened tables are not read in again
+    if isinstance(mspath, casatables.table):
         return mspath
     else:
         MS = casatables.table(mspath, ack=ack, readonly=readonly)
         return MS
 
+@functools.lru_cache(maxsize=32)
+def open_MS_table(tablepath, ack=False):
+    """Open a table (e.g. an MS or one of its subtables) read-only, and cache the
+    ``casacore.tables.table.table`` object, so subsequent calls on the same table
+    do not open it again. Opening a table is expensive, as casacore has to parse
+    the table descriptor and open the data manager files.
+
+    The returned table should **not** be closed by the caller, as it is shared between
+    the calls. Use ``clear_MS_cache`` to release the cached tables e.g. if the MS
+    has been modified on disk.
+
+    Parameters
+    ==========
+    tablepath: str
+        The input table path e.g. the MS path or the path of the FIELD subtable
+
+    ack: bool, optional
+        Enabling messages of successful interaction with the MS
+        e.g. successful opening of a table
+
+    Returns
+    =======
+    table: ``casacore.tables.table.table`` object
+        The read-only in-memory table
+    """
+    return casatables.table(tablepath, ack=ack, readonly=True)
+
+def get_column_chunked(table, colname, max_elements=2**29):
+    """Read a fixed shape column of a table in chunks of rows.
+
+    Reading a column with more than ~2^29 elements by a single ``getcol`` call can
+    silently return wrong data due to 32-bit indexing in casacore. This function reads
+    at most ``max_elements`` elements at once and assembles the column in a pre-allocated
+    array, which also bounds the temporary memory used by casacore.
+    For small columns this is equivalent to a single ``getcol`` call.
+
+    Parameters
+    ==========
+    table: ``casacore.tables.table.table`` object
+        The in-memory table
+
+    colname: str
+        Name of the column to be read
+
+    max_elements: int, optional
+        Maximum number of elements read by a single ``getcol`` call
+
+    Returns
+    =======
+    column: numpy ndarray
+        The column data with the rows along the first axis
+    """
+    N_rows = table.nrows()
+
+    #There is no cell to get the shape from in an empty table
+    if N_rows == 0:
+        return table.getcol(colname)
+
+    #The column is expected to have the same shape in each row
+    first_cell = np.asarray(table.getcell(colname, 0))
+
+    column = np.empty((N_rows,) + first_cell.shape, dtype=first_cell.dtype)
+
+    rows_per_chunk = max(1, max_elements // max(1, first_cell.size))
+
+    for startrow in range(0,N_rows,rows_per_chunk):
+        nrow = min(rows_per_chunk, N_rows - startrow)
+        column[startrow:startrow + nrow] = table.getcol(colname, startrow=startrow, nrow=nrow)
+
+    return column
+
+@functools.lru_cache(maxsize=32)
+def read_MS_phase_dir(mspath, ack=False):
+    """Read the PHASE_DIR column of the FIELD table of an MS and cache it, so subsequent
+    calls on the same MS (e.g. ``check_phaseref_in_MS`` followed by ``get_MS_phasecentre_all``)
+    share the same array.
+
+    The returned array is read-only as it is shared between the calls.
+    Use ``clear_MS_cache`` to release the cached arrays.
+
+    Parameters
+    ==========
+    mspath: str
+        The input MS path
+
+    ack: bool, optional
+        Enabling messages of successful interaction with the MS
+        e.g. successful opening of a table
+
+    Returns
+    =======
+    phase_dir: numpy ndarray
+        The phase centres in radians with the shape of the PHASE_DIR column,
+        the last axis being the (RA, Dec) pair
+
+    equinox: str
+        The reference equinox of the phase centres
+
+    cos_dec: numpy ndarray
+        Cosine of the declination of the phase centres, used for computing separations
+    """
+    fields_table = ds.msutil.open_MS_table(mspath + '/FIELD', ack=ack)
+
+    #Get the reference equinox from the table keywords
+    equinox = fields_table.getcolkeyword('PHASE_DIR','MEASINFO')['Ref'] 
+
+    #Only can convert from radians
+    assert fields_table.getcolkeyword('PHASE_DIR','QuantumUnits')[0] == 'rad', 'Phase centre direction is not in radians!'
+
+    phase_dir = ds.msutil.get_column_chunked(fields_table, 'PHASE_DIR')
+    phase_dir.flags.writeable = False
+
+    cos_dec = np.cos(phase_dir[...,1])
+    cos_dec.flags.writeable = False
+
+    return phase_dir, equinox, cos_dec
+
+def clear_MS_cache():
+    """Release the tables and arrays cached by ``open_MS_table`` and ``read_MS_phase_dir``.
+    The tables are closed when no other reference exists to them.
+    """
+    ds.msutil.read_MS_phase_dir.cache_clear()
+    ds.msutil.open_MS_table.cache_clear()
+
 def get_N_chan_from_MS(mspath, ack=False):
     """Get the number of channels from an MS
 
@@ -69,18 +196,14 @@ def get_N_chan_from_MS(mspath, ack=False):
     N_chan: int
         Number of channels in the MS
     """
-    MS = ds.msutil.create_MS_object(mspath, ack=ack)
-
-    spectral_windows_table = casatables.table(mspath + '/SPECTRAL_WINDOW', ack=ack)
+    spectral_windows_table = ds.msutil.open_MS_table(mspath + '/SPECTRAL_WINDOW', ack=ack)
 
     #Select firts index, channels can be different for different fields and dds maybe
-    N_chan = spectral_windows_table.getcol('NUM_CHAN')[0]
-
-    MS.close()
+    N_chan = spectral_windows_table.getcell('NUM_CHAN', 0)
 
     return N_chan
 
-def get_MS_phasecentre_all(mspath, frame='icrs', ack=False):
+def get_MS_phasecentre_all(mspath, frame='icrs', ack=False, as_array=False):
     """Get the list of the phase centres for each field and direction of the MS
     and return a list of astropy skycoord values
 
@@ -103,6 +226,11 @@ def get_MS_phasecentre_all(mspath, frame='icrs', ack=False):
     ack: bool, optional
         Enabling messages of successful interaction with the MS
         e.g. successful opening of a table
+
+    as_array: bool, optional
+        If True, a single array-valued Astropy skycoord is returned instead of a list of lists.
+        This is faster, and the array can be used directly in vectorised astropy operations
+        e.g. ``phasecentres.separation(phaseref)``
     
     Returns
     =======
@@ -110,53 +238,41 @@ def get_MS_phasecentre_all(mspath, frame='icrs', ack=False):
         A list of the phasecentres for each field and direction in the MS as a list of lists
         i.e. each element is a list
 
-    """
-    MS = ds.msutil.create_MS_object(mspath, ack=ack)
-
-    #Get the number of unique fields and data descriptoions (e.g. footprints)
-    fields = np.unique(MS.getcol('FIELD_ID'))
-    dds = np.unique(MS.getcol('DATA_DESC_ID'))
-
-    fields_table = casatables.table(mspath + '/FIELD', ack=ack)    
-
-    phasecentres = []
-
-    #Get the reference equinox from the table keywords
-    equinox = fields_table.getcolkeyword('PHASE_DIR','MEASINFO')['Ref'] 
-
-    #Only can convert from radians
-    assert fields_table.getcolkeyword('PHASE_DIR','QuantumUnits')[0] == 'rad', 'Phase centre direction is not in radians!'
+        If ``as_array`` is True, an array-valued Astropy skycoord with a shape of
+        (number of fields, number of directions), indexed the same way as the list of lists
 
-    i = 0
-    j = 0
-    for field in range(0,np.size(fields)):
-        #The number and referencing of fields can be messy
-        if np.shape(fields_table.getcol('PHASE_DIR'))[1] > np.size(fields):
-            field_ID = fields[i]
-        else:
-            field_ID = field
+    """
+    #Get the unique fields and data descriptoions (e.g. footprints)
+    #The selection is done by TaQL, so the full columns of the main table are not read into memory
+    with closing(casatables.taql('select distinct FIELD_ID from "{0:s}"'.format(mspath))) as fields_selection:
+        fields = np.unique(fields_selection.getcol('FIELD_ID'))
 
-        directions = []
+    with closing(casatables.taql('select distinct DATA_DESC_ID from "{0:s}"'.format(mspath))) as dds_selection:
+        dds = np.unique(dds_selection.getcol('DATA_DESC_ID'))
 
-        for dd in range(0,np.size(dds)):
-            #Same for the DDs as the fields
-            if np.shape(fields_table.getcol('PHASE_DIR'))[0] > np.size(dds):
-                dd_ID = dds[i]
-            else:
-                dd_ID = dd
+    #Read the phase centres only once
+    phase_dir, equinox, cos_dec = ds.msutil.read_MS_phase_dir(mspath, ack=ack)
 
-            pc = fields_table.getcol('PHASE_DIR')[dd_ID,field_ID, :]
+    #Convert all phase centres to astropy coordinates at once
+    all_coords = SkyCoord(ra=phase_dir[...,0] * u.rad, dec=phase_dir[...,1] * u.rad, frame=frame, equinox=equinox)
 
-            #Convert to astropy coordinates
-            directions.append(SkyCoord(ra=pc[0] * u.rad, dec=pc[1] * u.rad, frame=frame, equinox=equinox))
+    #The number and referencing of fields can be messy
+    if np.shape(phase_dir)[1] > np.size(fields):
+        field_IDs = fields
+    else:
+        field_IDs = np.arange(0,np.size(fields))
 
-            j += 1
-    
-    phasecentres.append(directions)
+    #Same for the DDs as the fields
+    if np.shape(phase_dir)[0] > np.size(dds):
+        dd_IDs = dds
+    else:
+        dd_IDs = np.arange(0,np.size(dds))
 
-    i += 1
+    if as_array:
+        #Select the valid phase centres and order the axes as (field, direction)
+        return all_coords[np.ix_(dd_IDs, field_IDs)].T
 
-    MS.close()
+    phasecentres = [[all_coords[dd_ID,field_ID] for dd_ID in dd_IDs] for field_ID in field_IDs]
 
     return phasecentres
 
@@ -189,9 +305,7 @@ def get_single_phasecentre_from_MS(mspath, field_ID=0, dd_ID=0, frame='icrs', ac
     phasecentre: Astropy coordinate 
         Phasecentre of the given field and direction
     """
-    MS = ds.msutil.create_MS_object(mspath, ack=ack)
-
-    fields_table = casatables.table(mspath + '/FIELD', ack=ack)    
+    fields_table = ds.msutil.open_MS_table(mspath + '/FIELD', ack=ack)
 
     #Get the reference equinox from the table keywords
     equinox = fields_table.getcolkeyword('PHASE_DIR','MEASINFO')['Ref'] 
@@ -199,12 +313,11 @@ def get_single_phasecentre_from_MS(mspath, field_ID=0, dd_ID=0, frame='icrs', ac
     #Only can convert from radians
     assert fields_table.getcolkeyword('PHASE_DIR','QuantumUnits')[0] == 'rad', 'Phase centre direction is not in radians!'
 
-    pc = fields_table.getcol('PHASE_DIR')[dd_ID,field_ID, :]
+    #Read only the cell needed, the first axis of the PHASE_DIR column is the row index
+    pc = fields_table.getcell('PHASE_DIR', dd_ID)[field_ID, :]
 
     direction = SkyCoord(ra=pc[0] * u.rad, dec=pc[1] * u.rad, frame=frame, equinox=equinox)
 
-    MS.close()
-
     return direction
 
 def check_phaseref_in_MS(mspath, phaseref, sep_threshold=1., frame='icrs', ack=False):
@@ -246,26 +359,37 @@ def check_phaseref_in_MS(mspath, phaseref, sep_threshold=1., frame='icrs', ack=F
     """
     assert type(phaseref) == type(SkyCoord(ra = 0 * u.deg, dec = 0 * u.deg, frame=frame, equinox='J2000')), 'Input phaseref is not an astropy SkyCoord object!'
 
-    MS = ds.msutil.create_MS_object(mspath, ack=ack)
+    #No separation can be below a negative threshold
+    if sep_threshold < 0:
+        return []
 
-    fields_table = casatables.table(mspath + '/FIELD', ack=ack)    
+    #Read the phase centres only once
+    phase_dir, equinox, cos_dec = ds.msutil.read_MS_phase_dir(mspath, ack=ack)
 
-    #Get the reference equinox from the table keywords
-    equinox = fields_table.getcolkeyword('PHASE_DIR','MEASINFO')['Ref'] 
+    #Transform the phaseref into the frame of the phase centres only once, so the separations
+    #can be computed directly on the PHASE_DIR array without any astropy frame transformation
+    ms_frame = SkyCoord(ra=0 * u.rad, dec=0 * u.rad, frame=frame, equinox=equinox).frame
+    ref = phaseref.transform_to(ms_frame).spherical
+    ra_ref = ref.lon.rad
+    dec_ref = ref.lat.rad
 
-    #Only can convert from radians
-    assert fields_table.getcolkeyword('PHASE_DIR','QuantumUnits')[0] == 'rad', 'Phase centre direction is not in radians!'
+    #Haversine of the angular separation of all phase centres from the phaseref
+    dra = phase_dir[...,0] - ra_ref
+    ddec = phase_dir[...,1] - dec_ref
+    hav = np.sin(ddec / 2)**2 + np.cos(dec_ref) * cos_dec * np.sin(dra / 2)**2
 
-    IDs = []
+    #Rounding errors can push the haversine slightly out of its [0,1] range
+    np.clip(hav, 0., 1., out=hav)
 
-    for d in range(0,np.shape(fields_table.getcol('PHASE_DIR'))[0]):
-        for f in range(0,np.shape(fields_table.getcol('PHASE_DIR'))[1]):
-            pc = fields_table.getcol('PHASE_DIR')[d,f, :]
+    #The haversine is monotonic in the separation between 0 and 180 degrees, so it can be compared
+    #to the haversine of the threshold directly instead of converting each value back to a separation
+    #No separation is larger than 180 degrees, hence larger thresholds are clipped to keep this valid
+    hav_threshold = np.sin(np.radians(min(sep_threshold, 180. * 3600.) / 3600.) / 2)**2
 
-            if phaseref.separation(SkyCoord(ra=pc[0] * u.rad, dec=pc[1] * u.rad, frame=frame, equinox=equinox)).arcsecond <= sep_threshold:
-                IDs.append([f,d])
+    #The indices are returned in the same (direction, field) order as the PHASE_DIR array
+    d_idx, f_idx = np.where(hav <= hav_threshold)
 
-    MS.close()
+    IDs = [[f,d] for d, f in zip(d_idx.tolist(), f_idx.tolist())]
 
     return IDs
 
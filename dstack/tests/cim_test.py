@@ -99,6 +99,11 @@ class TestCIM(unittest.TestCase):
         np.zeros((np.shape(casaimage.image(self.CIMPathA).getdata())[2],np.shape(casaimage.image(self.CIMPathA).getdata())[3]))) == True, \
         'Failed to produce a difference image of zeros using CIM A!'
 
+    def test_iterate_CIM_diff_slabs(self):
+        for chan, pol, diff_array in ds.cim.iterate_CIM_diff_slabs(self.CIMPathA,self.CIMPathA):
+            assert np.count_nonzero(diff_array) == 0, \
+            'Failed to produce a difference slab of zeros using CIM A for channel {0:d} and polarization {1:d}!'.format(chan,pol)
+
     def test_measure_CIM_RMS(self):
         assert np.isclose(ds.cim.measure_CIM_RMS(self.CIMPathA),self.RMS,rtol=1e-7), \
         'The given RMS and the RMS measured on the image are not matching!'
@@ -109,6 +114,23 @@ class TestCIM(unittest.TestCase):
         assert np.array_equiv(np.multiply(casaimage.image(self.CIMPathA).getdata(),2),casaimage.image('{0:s}/test_CIM_stacking_base'.format(TEST_DIR)).getdata()), \
         'Stacking the same image not equivalent with multiplying with two!'
 
+    def test_CIM_stacking_base_chan_blocks(self):
+        ds.cim.CIM_stacking_base([self.CIMPathA,self.CIMPathA],TEST_DIR,'test_CIM_stacking_base_chan_blocks',overwrite=True,chan_block_size=1)
+
+        assert np.array_equiv(np.multiply(casaimage.image(self.CIMPathA).getdata(),2),casaimage.image('{0:s}/test_CIM_stacking_base_chan_blocks'.format(TEST_DIR)).getdata()), \
+        'Stacking the same image channel-by-channel not equivalent with multiplying with two!'
+
+    def test_CIM_stacking_base_distinct_images(self):
+        #Stack the first image with a copy of it, so two different images are read
+        CIMPathA = self.CIMPathA.name()
+        CIMPathA_copy = '{0:s}/test_CIM_stacking_base_distinct_images_copy'.format(TEST_DIR)
+        self.CIMPathA.saveas(CIMPathA_copy, overwrite=True)
+
+        ds.cim.CIM_stacking_base([CIMPathA,CIMPathA_copy],TEST_DIR,'test_CIM_stacking_base_distinct_images',overwrite=True)
+
+        assert np.array_equiv(np.multiply(casaimage.image(CIMPathA).getdata(),2),casaimage.image('{0:s}/test_CIM_stacking_base_distinct_images'.format(TEST_DIR)).getdata()), \
+        'Stacking an image and its copy not equivalent with multiplying with two!'
+
     def test_set_CIM_unit(self):
         test_cim_name = '{0:s}/test_set_CIM_unit'.format(TEST_DIR)
         template_cim = ds.cim.create_CIM_object(self.CIMPathA)
@@ -125,5 +147,31 @@ class TestCIM(unittest.TestCase):
         CIM_with_unit = ds.cim.create_CIM_object('{0:s}/test_set_CIM_unit'.format(TEST_DIR))
         assert CIM_with_unit.unit() == 'Jy', 'Unable to add unit to newly created CASAImage!'
 
+class TestCIMComparison(unittest.TestCase):
+    """The array comparison helpers work on numpy arrays, hence no CASAImage is needed for testing them"""
+
+    def test_fast_allclose_inf(self):
+        assert ds.cim.fast_allclose(np.array([1.,2.]),np.array([1.,np.inf]),1e-8) == False, \
+        'A finite and an infinite value are treated as equal!'
+        assert ds.cim.fast_allclose(np.array([-np.inf]),np.array([np.inf]),1e-8) == False, \
+        'Infinities with opposite sign are treated as equal!'
+        assert ds.cim.fast_allclose(np.array([np.inf,-np.inf]),np.array([np.inf,-np.inf]),1e-8) == True, \
+        'Infinities with the same sign are not treated as equal!'
+
+    def test_fast_allclose_nan(self):
+        assert ds.cim.fast_allclose(np.array([np.nan,1.]),np.array([np.nan,1.]),1e-8) == True, \
+        'NaN-s are not treated as equal!'
+        assert ds.cim.fast_allclose(np.array([np.nan]),np.array([1.]),1e-8) == False, \
+        'NaN and a finite value are treated as equal!'
+
+    def test_chunked_allclose(self):
+        a = np.ones((2,3,4,5))
+        b = np.ones((2,3,4,5))
+        assert ds.cim.chunked_allclose(a,b,1e-8) == True, 'Identical cubes are not treated as equal!'
+
+        #Mismatch only in the last pixel of the last slab
+        b[-1,-1,-1,-1] = 2.
+        assert ds.cim.chunked_allclose(a,b,1e-8) == False, 'A mismatch in the last slab is not found!'
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
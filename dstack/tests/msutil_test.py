@@ -8,6 +8,7 @@ import os
 import unittest
 import configparser
 import ast
+import numpy as np
 
 from astropy.coordinates import SkyCoord
 from astropy import units as u
@@ -81,6 +82,10 @@ class TestMSUtil(unittest.TestCase):
         PhaseCentres = ds.msutil.get_MS_phasecentre_all(self.MSpath)
         assert PhaseCentres[0][0].separation(self.PhaseCentre).arcsec < 1,'Reference PhaseCentre and MS PhaseCentre has >1 arcsec separation!'
 
+    def test_get_MS_phasecentre_all_as_array(self):
+        PhaseCentres = ds.msutil.get_MS_phasecentre_all(self.MSpath, as_array=True)
+        assert PhaseCentres[0,0].separation(self.PhaseCentre).arcsec < 1,'Reference PhaseCentre and MS PhaseCentre has >1 arcsec separation!'
+
     def test_get_single_phasecentre_from_MS(self):
         PhaseCentre = ds.msutil.get_single_phasecentre_from_MS(self.MSpath,field_ID=self.IDs[0],dd_ID=self.IDs[1])
         assert PhaseCentre.separation(self.PhaseCentre).arcsec < 1,'Reference PhaseCentre and MS PhaseCentre has >1 arcsec separation!'
@@ -90,6 +95,20 @@ class TestMSUtil(unittest.TestCase):
         assert found_IDs[0][0] == self.IDs[0], 'No matching field ID found!'
         assert found_IDs[0][1] == self.IDs[1], 'No matching direction ID found!'
 
+    def test_open_MS_table(self):
+        MS = ds.msutil.open_MS_table(self.MSpath)
+        assert ds.msutil.open_MS_table(self.MSpath) is MS, 'The opened MS is not cached!'
+
+        ds.msutil.clear_MS_cache()
+        assert ds.msutil.open_MS_table(self.MSpath) is not MS, 'The MS cache is not cleared!'
+
+    def test_get_column_chunked(self):
+        fields_table = ds.msutil.open_MS_table(self.MSpath + '/FIELD')
+
+        #Read a single row at once, so the chunked reading is used
+        phase_dir = ds.msutil.get_column_chunked(fields_table, 'PHASE_DIR', max_elements=1)
+        assert np.array_equal(phase_dir, fields_table.getcol('PHASE_DIR')), 'The column read in chunks differs from the column read at once!'
+
     def test_get_N_chan_from_MS(self):
         C = ds.msutil.get_N_chan_from_MS(self.MSpath)
         assert C == self.NChan, 'Reference and MS channel number is not the same!'